@@ -1,15 +1,21 @@
-from qgis.core import QgsProject, QgsVectorLayer, QgsRasterLayer
+from collections import Counter
+from functools import partial
+
+from qgis.core import (QgsApplication, QgsProject, QgsVectorLayer, QgsRasterLayer, QgsFeature, QgsFeatureRequest,
+                       QgsFeatureSink, QgsVectorLayerFeatureSource, QgsWkbTypes, QgsTask, QgsProcessingContext,
+                       QgsProcessingFeedback)
 from qgis.PyQt.QtWidgets import QAction, QMessageBox, QInputDialog
 from qgis.utils import iface
-import processing
-import tempfile
-import os
+
+from .pipeline import (build_pipeline, run_pipeline, prepare_geometry, remaining_centroids, collect_points,
+                       point_features, points_layer, sample_raster, clear_raster_cache)
 
 class DSM_DTMExtractor:
 
     def __init__(self, iface):
         self.iface = iface
         self.canvas = iface.mapCanvas()
+        self.task = None
 
     def initGui(self):
         # Add a toolbar button and menu item
@@ -22,6 +28,12 @@ class DSM_DTMExtractor:
         # Remove the plugin menu item and icon
         self.iface.removeToolBarIcon(self.action)
         self.iface.removePluginMenu("&DSM, DTM extractor", self.action)
+        # Stop a running extraction before closing the raster datasets kept open between runs
+        # The reference is dropped as soon as the task finishes, the task manager deletes finished tasks
+        if self.task is not None:
+            self.task.cancel()
+            self.task.waitForFinished()
+        clear_raster_cache()
 
     def run(self):
         # Get layers from QGIS canvas
@@ -43,6 +55,9 @@ class DSM_DTMExtractor:
             self.iface.messageBar().pushMessage("Error", "Not enough layers available on the canvas!", level=3)
             return
 
+        vector_layers = self.layersByName(vector_layers)
+        raster_layers = self.layersByName(raster_layers)
+
         # Allow the user to select the required layers
         centerline_layer = self.selectLayer(vector_layers, "Select the Centerline Layer")
         buffer_layer = self.selectLayer(vector_layers, "Select the Buffer Layer")
@@ -53,142 +68,119 @@ class DSM_DTMExtractor:
             self.iface.messageBar().pushMessage("Error", "Layer selection was canceled.", level=3)
             return
 
-        # Execute the processing steps using the selected layers
-        # Step 1: Buffer the centerline with 2m distance
-        buffer_output = processing.run("native:buffer", {
-            'INPUT': centerline_layer,
-            'DISTANCE': 2,
-            'SEGMENTS': 5,
-            'END_CAP_STYLE': 0,
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'DISSOLVE': False,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 2: Convert the buffered polygon to line features
-        poly_to_line_output = processing.run("native:polygonstolines", {
-            'INPUT': buffer_output,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 3: Merge the converted line with the original centerline
-        merge_output = processing.run("native:mergevectorlayers", {
-            'LAYERS': [poly_to_line_output, centerline_layer],
-            'CRS': centerline_layer.crs(),
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 4: Create points along the merged line geometry every 5m
-        points_along_output = processing.run("native:pointsalonglines", {
-            'INPUT': merge_output,
-            'DISTANCE': 5,
-            'START_OFFSET': 0,
-            'END_OFFSET': 0,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 5: Create a grid from buffer with 5m width and height, clipped to the shapefile
-        grid_output = processing.run("native:creategrid", {
-            'TYPE': 2,  # Rectangle (Polygon)
-            'EXTENT': buffer_layer.extent(),
-            'HSPACING': 5,
-            'VSPACING': 5,
-            'HOVERLAY': 0,
-            'VOVERLAY': 0,
-            'CRS': buffer_layer.crs(),
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        clipped_grid_output = processing.run("native:clip", {
-            'INPUT': grid_output,
-            'OVERLAY': buffer_layer,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 6: Extract centroids of the grid and clip them to the buffer shapefile
-        centroids_output = processing.run("native:centroids", {
-            'INPUT': clipped_grid_output,
-            'ALLPARTS': False,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Step 7: Select centroids by location (intersects buffer) and keep non-intersecting centroids
-        processing.run("qgis:selectbylocation", {
-            'INPUT': centroids_output,
-            'PREDICATE': [0],  # Intersects
-            'INTERSECT': buffer_output,
-            'METHOD': 0  # Create new selection
-        })
-
-        # Invert selection to get non-intersecting centroids
-        centroids_output.invertSelection()
-
-        # Save the non-intersecting centroids
-        remaining_centroids = processing.run("native:saveselectedfeatures", {
-            'INPUT': centroids_output,
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-        # Deselect all to avoid further issues
-        centroids_output.removeSelection()
-
-        # Step 8: Merge two vector layers (output from Step 4 and Step 7)
-        merged_output = processing.run("native:mergevectorlayers", {
-            'LAYERS': [points_along_output, remaining_centroids],
-            'CRS': points_along_output.crs(),  # Use CRS from one of the input layers
-            'OUTPUT': 'memory:'
-        })['OUTPUT']
-
-<<<<<<< HEAD
-=======
-        # Set the final output layer name to 'merged_point'
-       
-
->>>>>>> 13c4f21a5945d9a5c2b53a9782610d81abb928cc
-        # Step 9: Add raster values to the merged points (DTM)
-        band_count = dtm_raster_layer.bandCount()
-        temp_dir = tempfile.gettempdir()  # Use a temporary directory
-
-        for band_index in range(1, band_count + 1):
-            field_name = f"DTM_Band_{band_index}"
-            raster_values_output_path = os.path.join(temp_dir, f"raster_values_output_DTM_band_{band_index}.shp")
-
-            raster_values_output = processing.run("sagang:addrastervaluestopoints", {
-                'SHAPES': merged_output,
-                'GRIDS': dtm_raster_layer,
-                'RESULT': raster_values_output_path,  # Save to temp directory
-                'RESAMPLING': 3,
-                'BAND': band_index,
-                'FIELD': field_name
-            })['RESULT']
-
-            result_layer = QgsVectorLayer(raster_values_output, f"DTM_Band_{band_index}", "ogr")
+        # Execute the processing steps in the background, keeping a reference to the task until it finishes
+        # and disabling the action meanwhile
+        task = DSM_DTMExtractorTask(centerline_layer, buffer_layer, dtm_raster_layer, dsm_raster_layer)
+        task.taskCompleted.connect(partial(self.addResultLayers, task))
+        task.taskTerminated.connect(partial(self.reportFailure, task))
+        self.task = task
+        self.action.setEnabled(False)
+        QgsApplication.taskManager().addTask(task)
+
+    def addResultLayers(self, task):
+        """Helper function to add the sampled point layers of the task to the project (runs on the main thread)"""
+        self.task = None
+        self.action.setEnabled(True)
+        for result_layer in task.result_layers:
             QgsProject.instance().addMapLayer(result_layer)
 
-        # Step 10: Add raster values to the merged points (DSM)
-        band_count_dsm = dsm_raster_layer.bandCount()
+    def reportFailure(self, task):
+        """Helper function to report a failed or canceled extraction of the task"""
+        self.task = None
+        self.action.setEnabled(True)
+        message = str(task.exception) if task.exception else "Extraction was canceled."
+        self.iface.messageBar().pushMessage("Error", message, level=3)
 
-        for band_index in range(1, band_count_dsm + 1):
-            field_name_dsm = f"DSM_Band_{band_index}"
-            raster_values_output_DSM_path = os.path.join(temp_dir, f"raster_values_output_DSM_band_{band_index}.shp")
-
-            raster_values_output_DSM = processing.run("sagang:addrastervaluestopoints", {
-                'SHAPES': raster_values_output,
-                'GRIDS': dsm_raster_layer,
-                'RESULT': raster_values_output_DSM_path,  # Save to temp directory
-                'RESAMPLING': 3,
-                'BAND': band_index,
-                'FIELD': field_name_dsm
-            })['RESULT']
-
-            result_layer_DSM = QgsVectorLayer(raster_values_output_DSM, f"{dsm_raster_layer}+_DSM", "ogr")
-            QgsProject.instance().addMapLayer(result_layer_DSM)
+    def layersByName(self, layers):
+        """Helper function to index the layers by name, adding the layer id to repeated names"""
+        name_counts = Counter(layer.name() for layer in layers)
+        return {layer.name() if name_counts[layer.name()] == 1 else f"{layer.name()} ({layer.id()})": layer
+                for layer in layers}
 
     def selectLayer(self, layers, title):
-        """Helper function to select a layer from the list"""
-        layer_names = [layer.name() for layer in layers]
-        selected_name, ok = QInputDialog.getItem(self.iface.mainWindow(), title, "Select a layer:", layer_names, 0, False)
+        """Helper function to select a layer from the {name: layer} dict"""
+        selected_name, ok = QInputDialog.getItem(self.iface.mainWindow(), title, "Select a layer:", list(layers), 0, False)
         if ok and selected_name:
-            return next(layer for layer in layers if layer.name() == selected_name)
+            return layers.get(selected_name)
         return None
+
+
+class DSM_DTMExtractorTask(QgsTask):
+
+    def __init__(self, centerline_layer, buffer_layer, dtm_raster_layer, dsm_raster_layer):
+        super().__init__("DSM, DTM extractor", QgsTask.CanCancel)
+        # Layers must not be shared with the worker thread, so it reads thread safe feature sources of the
+        # already loaded layers instead of reopening their files on every run
+        self.centerline_source = QgsVectorLayerFeatureSource(centerline_layer)
+        self.centerline_geometry_type = QgsWkbTypes.displayString(centerline_layer.wkbType())
+        self.buffer_source = QgsVectorLayerFeatureSource(buffer_layer)
+        self.centerline_crs = centerline_layer.crs()
+        self.transform_context = QgsProject.instance().transformContext()
+        self.dtm = (dtm_raster_layer.source(), dtm_raster_layer.name())
+        self.dsm = (dsm_raster_layer.source(), dsm_raster_layer.name())
+        self.feedback = QgsProcessingFeedback()
+        self.result_layers = []
+        self.exception = None
+
+    def run(self):
+        try:
+            self.extract()
+        except Exception as e:
+            self.exception = e
+            return False
+        return not self.isCanceled()
+
+    def cancel(self):
+        self.feedback.cancel()
+        super().cancel()
+
+    def extract(self):
+        context = QgsProcessingContext()
+        # Step 1 takes a layer, so the centerline geometries are copied into a memory layer
+        centerline_layer = QgsVectorLayer(self.centerline_geometry_type, "centerline", "memory")
+        centerline_layer.setCrs(self.centerline_crs)
+        centerline_features = []
+        for feature in self.centerline_source.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            centerline_feature = QgsFeature()
+            centerline_feature.setGeometry(feature.geometry())
+            centerline_features.append(centerline_feature)
+        centerline_layer.dataProvider().addFeatures(centerline_features, QgsFeatureSink.FastInsert)
+        dtm_path, dtm_name = self.dtm
+        dsm_path, dsm_name = self.dsm
+
+        # Step 1: Run the processing algorithms shared with the batch runner
+        buffer_output = run_pipeline(build_pipeline(centerline_layer), context, self.feedback)['buffer_output']
+        self.setProgress(20)
+
+        # Prepare the buffer polygons and the buffered centerline once for all point-in-polygon tests
+        # The buffer polygons are brought into the CRS of the centerline, which all other steps use
+        buffer_request = QgsFeatureRequest().setDestinationCrs(self.centerline_crs, self.transform_context)
+        buffer_polygon, buffer_engine = prepare_geometry(self.buffer_source, buffer_request)
+        buffer_band, band_engine = prepare_geometry(buffer_output)
+
+        # Steps 5-7: Grid centroids inside the buffer layer but outside the buffered centerline
+        centroids = remaining_centroids(buffer_polygon.boundingBox(), buffer_engine, band_engine)
+        self.setProgress(60)
+
+        # Steps 2-4 and 8: Densify the buffer boundary and centerline and merge them with the remaining centroids
+        coords = collect_points(buffer_output, centerline_layer, centroids)
+        self.setProgress(80)
+
+        # Step 9: Add raster values of all DTM bands to the merged points (nearest cell lookup)
+        # The point features are built once and fill both result layers
+        crs = buffer_output.crs()
+        features = point_features(coords)
+        dtm_values = sample_raster(dtm_path, coords, crs.toWkt())
+        result_layer_DTM = points_layer(features, crs, f"{dtm_name}_DTM", [('DTM_Band_', dtm_values)])
+
+        # Step 10: Add raster values of the DTM and all DSM bands to a second point layer
+        dsm_values = sample_raster(dsm_path, coords, crs.toWkt())
+        result_layer_DSM = points_layer(features, crs, f"{dsm_name}_DSM",
+                                        [('DTM_Band_', dtm_values), ('DSM_Band_', dsm_values)])
+
+        # Hand the result layers over to the main thread, where they are added to the project
+        for result_layer in (result_layer_DTM, result_layer_DSM):
+            result_layer.moveToThread(QgsApplication.instance().thread())
+            self.result_layers.append(result_layer)
+        self.setProgress(100)
+
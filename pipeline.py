@@ -0,0 +1,327 @@
+"""Processing steps shared by the plugin and the standalone batch runner.
+
+The batch runner runs all steps through PyQGIS in a single process, without starting
+the QGIS desktop, e.g.:
+
+    python pipeline.py centerline.shp buffer.shp dtm.tif dsm.tif output.gpkg
+"""
+import argparse
+import os
+import threading
+from functools import lru_cache
+
+from qgis.analysis import QgsNativeAlgorithms
+from qgis.core import (QgsApplication, QgsCoordinateTransformContext, QgsFeature, QgsFeatureRequest, QgsFeatureSink,
+                       QgsField, QgsGeometry, QgsPoint, QgsPointXY, QgsProcessing, QgsProcessingContext,
+                       QgsProcessingException, QgsProcessingFeedback, QgsVectorFileWriter, QgsVectorLayer)
+from qgis.PyQt.QtCore import QVariant
+from osgeo import gdal, osr
+import numpy as np
+
+# Raster tile size in pixels used to read the DTM/DSM block by block
+TILE_SIZE = 512
+
+
+def build_pipeline(centerline):
+    """Return the (name, algorithm id, parameters) of every processing algorithm step.
+
+    The input may be a layer or a layer source. A parameter value of "@name" refers to
+    the output of the earlier step called name.
+    """
+    return [
+        # Step 1: Buffer the centerline with 2m distance
+        ('buffer_output', "native:buffer", {
+            'INPUT': centerline,
+            'DISTANCE': 2,
+            'SEGMENTS': 5,
+            'END_CAP_STYLE': 0,
+            'JOIN_STYLE': 0,
+            'MITER_LIMIT': 2,
+            'DISSOLVE': False,
+            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+        }),
+    ]
+
+
+def resolve_params(params, outputs):
+    """Replace "@name" references in the step parameters with the earlier step outputs"""
+    def resolve(value):
+        if isinstance(value, str) and value.startswith('@'):
+            return outputs[value[1:]]
+        if isinstance(value, list):
+            return [resolve(item) for item in value]
+        return value
+    return {key: resolve(value) for key, value in params.items()}
+
+
+def run_pipeline(steps, context, feedback):
+    """Run the processing algorithm steps and return the {name: output layer} of every step"""
+    registry = QgsApplication.processingRegistry()
+    outputs = {}
+    for name, alg_id, params in steps:
+        algorithm = registry.createAlgorithmById(alg_id)
+        if algorithm is None:
+            raise QgsProcessingException(f"Processing algorithm {alg_id} is not available.")
+        # Let a failing algorithm raise its own error instead of only returning ok=False
+        results, _ = algorithm.run(resolve_params(params, outputs), context, feedback, catchExceptions=False)
+        outputs[name] = context.takeResultLayer(results['OUTPUT'])
+    return outputs
+
+
+# GDAL datasets must not be used from two threads at once, the cached ones are only used under this lock
+_raster_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _open_raster(raster_path, modified):
+    """Open the raster with GDAL, cached per path and modification time"""
+    dataset = gdal.Open(raster_path)
+    if dataset is None:
+        # Raising keeps the failure out of the cache
+        raise QgsProcessingException(f"Could not open the raster {raster_path} with GDAL.")
+    return dataset
+
+
+@lru_cache(maxsize=32)
+def _read_band(raster_path, modified, band_index, window):
+    """Read a (col, row, width, height) window of a raster band and its nodata value, cached per window"""
+    band = _open_raster(raster_path, modified).GetRasterBand(band_index)
+    array = band.ReadAsArray(*window)
+    array.flags.writeable = False
+    return array, band.GetNoDataValue()
+
+
+def clear_raster_cache():
+    """Close the cached raster datasets and drop the cached bands"""
+    with _raster_lock:
+        _read_band.cache_clear()
+        _open_raster.cache_clear()
+
+
+def to_raster_crs(dataset, coords, crs_wkt):
+    """Transform the (N, 2) coordinates from crs_wkt to the raster CRS in one batched call"""
+    if not crs_wkt or not dataset.GetProjection():
+        return coords
+    source = osr.SpatialReference(wkt=crs_wkt)
+    target = osr.SpatialReference(wkt=dataset.GetProjection())
+    if source.IsSame(target):
+        return coords
+    # GDAL 3 follows the authority axis order unless told otherwise, GDAL 2 always uses x/y order
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        for srs in (source, target):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(source, target)
+    return np.asarray(transform.TransformPoints(coords.tolist()), dtype=np.float64).reshape(-1, 3)[:, :2]
+
+
+def sample_raster(raster_path, coords, crs_wkt=None):
+    """Read the nearest cell value of every band at the given coordinates (in crs_wkt, if given)"""
+    with _raster_lock:
+        return _sample_raster(raster_path, coords, crs_wkt)
+
+
+def _sample_raster(raster_path, coords, crs_wkt):
+    # Rasters are re-read only when the file changed since the previous run
+    modified = os.path.getmtime(raster_path) if os.path.exists(raster_path) else None
+    dataset = _open_raster(raster_path, modified)
+    coords = to_raster_crs(dataset, coords, crs_wkt)
+    x_origin, pixel_width, _, y_origin, _, pixel_height = dataset.GetGeoTransform()
+    cols = np.floor((coords[:, 0] - x_origin) / pixel_width).astype(np.int64)
+    rows = np.floor((coords[:, 1] - y_origin) / pixel_height).astype(np.int64)
+    inside = (cols >= 0) & (cols < dataset.RasterXSize) & (rows >= 0) & (rows < dataset.RasterYSize)
+
+    values = np.full((len(coords), dataset.RasterCount), np.nan)
+    if not inside.any():
+        return values
+
+    # Group the points by raster tile so every tile is read once and stays resident while its points are looked up
+    point_index = np.flatnonzero(inside)
+    rows, cols = rows[inside], cols[inside]
+    tile_keys = (rows // TILE_SIZE) * (dataset.RasterXSize // TILE_SIZE + 1) + cols // TILE_SIZE
+    order = np.argsort(tile_keys, kind='stable')
+    for tile in np.split(order, np.flatnonzero(np.diff(tile_keys[order])) + 1):
+        row_offset = int(rows[tile[0]]) // TILE_SIZE * TILE_SIZE
+        col_offset = int(cols[tile[0]]) // TILE_SIZE * TILE_SIZE
+        window = (col_offset, row_offset, min(TILE_SIZE, dataset.RasterXSize - col_offset),
+                  min(TILE_SIZE, dataset.RasterYSize - row_offset))
+        for band_index in range(1, dataset.RasterCount + 1):
+            array, nodata = _read_band(raster_path, modified, band_index, window)
+            band_values = array[rows[tile] - row_offset, cols[tile] - col_offset].astype(np.float64)
+            if nodata is not None:
+                band_values[band_values == nodata] = np.nan
+            values[point_index[tile], band_index - 1] = band_values
+    return values
+
+
+def line_parts(geometry):
+    """Return the (N, 2) vertex array of every part of a line geometry"""
+    polylines = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
+    return [np.asarray([(point.x(), point.y()) for point in polyline], dtype=np.float64).reshape(-1, 2)
+            for polyline in polylines]
+
+
+def densify(vertices, step=5.0):
+    """Return the (M, 2) points every step along the polyline vertices, including both ends when the length allows"""
+    if len(vertices) < 2:
+        return vertices[:1]
+    segments = np.diff(vertices, axis=0)
+    lengths = np.hypot(segments[:, 0], segments[:, 1])
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+
+    # Locate the segment of every sample distance and interpolate linearly inside it
+    distances = np.arange(0.0, cumulative[-1] + 1e-9, step)
+    index = np.clip(np.searchsorted(cumulative, distances, side='right') - 1, 0, len(segments) - 1)
+    ratio = np.divide(distances - cumulative[index], lengths[index],
+                      out=np.zeros_like(distances), where=lengths[index] > 0)
+    return vertices[index] + ratio[:, None] * segments[index]
+
+
+def prepare_geometry(layer, request=None):
+    """Return the union of the layer (or feature source) geometries and a prepared GEOS engine for it.
+
+    The request can reproject the geometries, e.g. with setDestinationCrs. The engine refers
+    to the geometry, so both have to be kept alive together.
+    """
+    features = layer.getFeatures(request or QgsFeatureRequest())
+    geometry = QgsGeometry.unaryUnion([feature.geometry() for feature in features]).makeValid()
+    engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+    engine.prepareGeometry()
+    return geometry, engine
+
+
+def remaining_centroids(extent, buffer_engine, band_engine, spacing=5.0):
+    """Return the (N, 2) grid centroids inside the buffer polygons that fall outside the buffered centerline"""
+    # Step 5: Centroids of a grid from the top left corner of the buffer extent
+    cols = np.ceil(extent.width() / spacing)
+    rows = np.ceil(extent.height() / spacing)
+    xs = extent.xMinimum() + spacing / 2 + spacing * np.arange(cols)
+    ys = extent.yMaximum() - spacing / 2 - spacing * np.arange(rows)
+    centroids = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+    # Steps 6 and 7: Prepared predicate tests per centroid instead of clip, centroids and select by location
+    keep = np.fromiter((buffer_engine.contains(point) and not band_engine.intersects(point)
+                        for point in (QgsPoint(x, y) for x, y in centroids)), dtype=bool, count=len(centroids))
+    return centroids[keep]
+
+
+def collect_points(buffer_output, centerline_layer, centroids):
+    """Return the (N, 2) densified boundary and centerline points merged with the remaining centroids"""
+    # Steps 2-4: Create points every 5m along the buffer boundary and the original centerline
+    parts = []
+    for feature in buffer_output.getFeatures():
+        parts.extend(line_parts(QgsGeometry(feature.geometry().constGet().boundary())))
+    for feature in centerline_layer.getFeatures():
+        parts.extend(line_parts(feature.geometry()))
+
+    # Step 8: Merge them with the remaining centroids (output from Step 7)
+    return unique_points(np.concatenate([densify(vertices) for vertices in parts] + [centroids]))
+
+
+def unique_points(coords, tolerance=0.1):
+    """Drop points falling on the same tolerance grid cell as an earlier point, keeping the original order"""
+    keys = np.round(coords / tolerance).astype(np.int64)
+    _, index = np.unique(keys, axis=0, return_index=True)
+    return coords[np.sort(index)]
+
+
+def point_features(coords):
+    """Return a point feature without attributes for every coordinate"""
+    features = []
+    for x, y in coords:
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+        features.append(feature)
+    return features
+
+
+def points_layer(features, crs, name, columns):
+    """Return a memory point layer with the point features.
+
+    Every (prefix, values) column adds a field per band of the (N, bands) sampled values,
+    NaN values are written as NULL. The attributes of the features are replaced, so the same
+    features can fill several layers.
+    """
+    # Set the CRS on the layer, a CRS without an authid would be lost in the memory layer uri
+    layer = QgsVectorLayer("Point", name, "memory")
+    layer.setCrs(crs)
+    provider = layer.dataProvider()
+    provider.addAttributes([QgsField(f"{prefix}{band_index}", QVariant.Double)
+                            for prefix, values in columns for band_index in range(1, values.shape[1] + 1)])
+    layer.updateFields()
+
+    # The attributes are set before inserting, so the layer is written in a single batch
+    values = np.hstack([values for _, values in columns])
+    for feature, row in zip(features, values):
+        feature.setAttributes([None if np.isnan(value) else float(value) for value in row])
+
+    # Added straight to the provider in one batch, bypassing the edit buffer and its per-feature signals
+    provider.addFeatures(features, QgsFeatureSink.FastInsert)
+    layer.updateExtents()
+    return layer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract DTM and DSM values without the QGIS desktop.")
+    parser.add_argument('centerline', help="Centerline vector file")
+    parser.add_argument('buffer', help="Buffer polygon vector file")
+    parser.add_argument('dtm', help="DTM raster file")
+    parser.add_argument('dsm', help="DSM raster file")
+    parser.add_argument('output', help="Output GeoPackage with the sampled points")
+    args = parser.parse_args(argv)
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    try:
+        # The desktop registers the native algorithms itself, a standalone application has to add them
+        QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+        run_batch(args)
+    finally:
+        qgs.exitQgis()
+
+
+def load_layer(path, name):
+    """Load a vector layer with OGR, stopping the batch run when it is not valid"""
+    layer = QgsVectorLayer(path, name, 'ogr')
+    if not layer.isValid():
+        raise SystemExit(f"Could not load the {name} layer from {path}")
+    return layer
+
+
+def run_batch(args):
+    """Run all steps for the command line arguments"""
+    # Check the inputs before running any step
+    centerline_layer = load_layer(args.centerline, 'centerline')
+    buffer_layer = load_layer(args.buffer, 'buffer')
+    for path in (args.dtm, args.dsm):
+        if not os.path.exists(path):
+            raise SystemExit(f"Could not find the raster {path}")
+
+    try:
+        outputs = run_pipeline(build_pipeline(centerline_layer), QgsProcessingContext(), QgsProcessingFeedback())
+    except QgsProcessingException as e:
+        raise SystemExit(f"Processing failed: {e}")
+    buffer_output = outputs['buffer_output']
+
+    # Bring the buffer polygons into the CRS of the centerline, which all other steps use
+    buffer_request = QgsFeatureRequest().setDestinationCrs(buffer_output.crs(), QgsCoordinateTransformContext())
+    buffer_polygon, buffer_engine = prepare_geometry(buffer_layer, buffer_request)
+    buffer_band, band_engine = prepare_geometry(buffer_output)
+    centroids = remaining_centroids(buffer_polygon.boundingBox(), buffer_engine, band_engine)
+    coords = collect_points(buffer_output, centerline_layer, centroids)
+
+    # Step 9 and 10: Add raster values of all DTM and DSM bands to the merged points
+    crs_wkt = buffer_output.crs().toWkt()
+    merged_output = points_layer(point_features(coords), buffer_output.crs(), 'merged_output', [
+        ('DTM_Band_', sample_raster(args.dtm, coords, crs_wkt)),
+        ('DSM_Band_', sample_raster(args.dsm, coords, crs_wkt)),
+    ])
+
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    result = QgsVectorFileWriter.writeAsVectorFormatV2(merged_output, args.output, QgsCoordinateTransformContext(),
+                                                       options)
+    if result[0] != QgsVectorFileWriter.NoError:
+        raise SystemExit(f"Could not write {args.output}: {result[1]}")
+
+if __name__ == '__main__':
+    main()